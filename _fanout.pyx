@@ -0,0 +1,15 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+from asyncio import QueueFull
+
+
+def broadcast_payload(list puts, bytes payload):
+    # Call every subscriber's queue put_nowait with the shared payload and
+    # return the indices of the queues that were full
+    cdef Py_ssize_t i
+    cdef list full = []
+    for i in range(len(puts)):
+        try:
+            puts[i](payload)
+        except QueueFull:
+            full.append(i)
+    return full
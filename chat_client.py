@@ -1,11 +1,35 @@
 import asyncio
 import json
+import os
 import sys
+import zlib
 from argparse import ArgumentParser
-from typing import List
+from typing import Awaitable, Callable, List
 
 import websockets
 
+try:
+    import orjson
+except ImportError:  # Optional speedup; fall back to the stdlib json module
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:  # Optional faster event loop; asyncio's default is used otherwise
+    uvloop = None
+
+if orjson is not None:
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+else:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    _loads = json.loads
+
+# Leading byte the server puts on zlib-compressed frames
+COMPRESSED_TAG = b"\x01"
+
 
 def build_parser() -> ArgumentParser:
     parser = ArgumentParser(description="Simple WebSocket chat client")
@@ -18,44 +42,87 @@ def build_parser() -> ArgumentParser:
 
 async def receiver(ws: websockets.WebSocketClientProtocol) -> None:
     async for raw in ws:
+        if isinstance(raw, bytes) and raw[:1] == COMPRESSED_TAG:
+            raw = zlib.decompress(raw[1:])
         try:
-            data = json.loads(raw)
+            data = _loads(raw)
         except json.JSONDecodeError:
             print(raw)
             continue
 
-        msg_type = data.get("type")
-        if msg_type == "error":
-            print(f"[ERROR] {data.get('code')}: {data.get('message')}")
-        elif msg_type == "ok":
-            event = data.get("event")
-            if event == "login_ok":
-                print(f"Logged in as {data.get('username')}")
-            elif event == "subscribed":
-                print(f"Subscribed to room {data.get('room')}")
-            elif event == "logout_ok":
-                print("Logged out.")
-        elif msg_type == "history":
-            room = data.get("room")
-            messages: List[dict] = data.get("messages", [])
-            if messages:
-                print(f"--- Last {len(messages)} messages in {room} ---")
-                for m in messages:
-                    print(f"[{m.get('ts')}] {m.get('room')} | {m.get('username')}: {m.get('message')}")
-                print("-------------------------------------------")
-        elif msg_type == "message":
-            print(f"[{data.get('ts')}] {data.get('room')} | {data.get('username')}: {data.get('message')}")
-        else:
-            print(raw)
+        # The server coalesces queued messages into a single JSON array frame
+        for event in data if isinstance(data, list) else [data]:
+            display(event)
+
+
+def display(data: dict) -> None:
+    msg_type = data.get("type")
+    if msg_type == "error":
+        print(f"[ERROR] {data.get('code')}: {data.get('message')}")
+    elif msg_type == "ok":
+        event = data.get("event")
+        if event == "login_ok":
+            print(f"Logged in as {data.get('username')}")
+        elif event == "subscribed":
+            print(f"Subscribed to room {data.get('room')}")
+        elif event == "logout_ok":
+            print("Logged out.")
+    elif msg_type == "history":
+        room = data.get("room")
+        messages: List[dict] = data.get("messages", [])
+        if messages:
+            print(f"--- Last {len(messages)} messages in {room} ---")
+            for m in messages:
+                print(f"[{m.get('ts')}] {m.get('room')} | {m.get('username')}: {m.get('message')}")
+            print("-------------------------------------------")
+    elif msg_type == "message":
+        print(f"[{data.get('ts')}] {data.get('room')} | {data.get('username')}: {data.get('message')}")
+    else:
+        print(data)
+
+
+def stdin_line_reader(loop: asyncio.AbstractEventLoop) -> Callable[[], Awaitable[str]]:
+    # Returns a coroutine function yielding stdin lines ("" at end of input).
+    # The event loop reads stdin whenever it becomes readable and complete
+    # lines are queued; raw reads are split here so no line can be left in a
+    # buffered reader. Stdin that cannot be polled (regular files, Windows)
+    # falls back to a blocking readline in the executor.
+    fd = sys.stdin.fileno()
+    lines: asyncio.Queue = asyncio.Queue()
+    partial = bytearray()
+
+    def on_readable() -> None:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            loop.remove_reader(fd)
+            if partial:
+                lines.put_nowait(partial.decode("utf-8", errors="replace"))
+            lines.put_nowait("")
+            return
+        partial.extend(chunk)
+        end = partial.rfind(b"\n") + 1
+        if end:
+            for line in partial[: end - 1].decode("utf-8", errors="replace").split("\n"):
+                lines.put_nowait(line + "\n")
+            del partial[:end]
+
+    try:
+        loop.add_reader(fd, on_readable)
+    except (NotImplementedError, OSError, ValueError):
+        return lambda: loop.run_in_executor(None, sys.stdin.readline)
+    return lines.get
 
 
 async def stdin_publisher(ws: websockets.WebSocketClientProtocol) -> None:
     print("Type '/join ROOM' to subscribe to a room. Type '/quit' to exit.")
     print("Publish with 'ROOM: your message' or just 'your message' to send to last used room.")
     last_room = None
-    loop = asyncio.get_running_loop()
+    # Encoded publish command up to the message, rebuilt when the room changes
+    pub_room = None
+    pub_prefix = b""
+    readline = stdin_line_reader(asyncio.get_running_loop())
     while True:
-        line = await loop.run_in_executor(None, sys.stdin.readline)
+        line = await readline()
         if not line:
             await ws.close()
             return
@@ -63,12 +130,12 @@ async def stdin_publisher(ws: websockets.WebSocketClientProtocol) -> None:
         if line == "":
             continue
         if line.startswith("/quit"):
-            await ws.send(json.dumps({"action": "logout"}))
+            await ws.send(_dumps({"action": "logout"}))
             await ws.close()
             return
         if line.startswith("/join "):
             _, room = line.split(" ", 1)
-            await ws.send(json.dumps({"action": "subscribe", "room": room.strip()}))
+            await ws.send(_dumps({"action": "subscribe", "room": room.strip()}))
             last_room = room.strip()
             continue
 
@@ -85,25 +152,30 @@ async def stdin_publisher(ws: websockets.WebSocketClientProtocol) -> None:
             room = last_room
             message = line
 
-        await ws.send(json.dumps({"action": "publish", "room": room, "message": message}))
+        if room != pub_room:
+            pub_room = room
+            pub_prefix = b'{"action":"publish","room":' + _dumps(room) + b',"message":'
+        await ws.send(pub_prefix + _dumps(message) + b"}")
 
 
 async def main() -> None:
     parser = build_parser()
     args = parser.parse_args()
     uri = f"ws://{args.host}:{args.port}"
-    async with websockets.connect(uri) as ws:
+    async with websockets.connect(uri, compression=None) as ws:
         # Login
-        await ws.send(json.dumps({"action": "login", "username": args.username}))
+        await ws.send(_dumps({"action": "login", "username": args.username}))
         # Subscribe initial rooms
         for room in args.rooms:
-            await ws.send(json.dumps({"action": "subscribe", "room": room}))
+            await ws.send(_dumps({"action": "subscribe", "room": room}))
 
         # Run receiver and stdin publisher concurrently
         await asyncio.gather(receiver(ws), stdin_publisher(ws))
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -1,18 +1,145 @@
 import asyncio
 import json
+import logging
+import multiprocessing
 import os
-from collections import defaultdict, deque
-from datetime import datetime, timezone
-from typing import Deque, Dict, Set
+import signal
+import socket
+import struct
+import sys
+import time
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from functools import lru_cache
+from typing import BinaryIO, Callable, Dict, List, Optional, Set, Tuple
 
 import websockets
 
+try:
+    import orjson
+except ImportError:  # Optional speedup; fall back to the stdlib encoder
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:  # Optional lazy parser; frames are fully decoded otherwise
+    simdjson = None
+
+try:
+    from _fanout import broadcast_payload
+except ImportError:  # Compiled fan-out loop not built (see setup.py); use the Python one
+    broadcast_payload = None
+
+try:
+    import uvloop
+except ImportError:  # Optional faster event loop; asyncio's default is used otherwise
+    uvloop = None
+
 
 HOST = os.environ.get("CHAT_HOST", "0.0.0.0")
 PORT = int(os.environ.get("CHAT_PORT", "2024"))
 LOG_DIR = os.path.abspath(os.environ.get("CHAT_LOG_DIR", os.path.join(os.getcwd(), "logs")))
 HISTORY_SIZE = int(os.environ.get("CHAT_HISTORY_SIZE", "100"))
 HISTORY_ON_SUBSCRIBE = int(os.environ.get("CHAT_HISTORY_ON_SUBSCRIBE", "5"))
+# Broadcast payloads at least this large are zlib-compressed once for all subscribers
+COMPRESS_MIN_SIZE = int(os.environ.get("CHAT_COMPRESS_MIN_SIZE", "256"))
+# Leading byte marking a zlib-compressed frame (JSON frames start with '{' or '[')
+COMPRESSED_TAG = b"\x01"
+# Outbound frames buffered per connection before it is dropped as a slow consumer
+SEND_QUEUE_SIZE = int(os.environ.get("CHAT_SEND_QUEUE_SIZE", "256"))
+# Maximum queued messages coalesced into a single outbound frame
+SEND_BATCH = int(os.environ.get("CHAT_SEND_BATCH", "32"))
+# Size at which a coalesced frame is cut short, well under clients' 1 MiB max_size
+SEND_BATCH_BYTES = int(os.environ.get("CHAT_SEND_BATCH_BYTES", "65536"))
+# Fixed slot width of the on-disk history ring; longer records are truncated
+LOG_RECORD_SIZE = int(os.environ.get("CHAT_LOG_RECORD_SIZE", "1024"))
+# Interval between batched log writes, and between fdatasync calls, in milliseconds
+LOG_FLUSH_INTERVAL = int(os.environ.get("CHAT_LOG_FLUSH_MS", "50")) / 1000
+LOG_SYNC_INTERVAL = int(os.environ.get("CHAT_LOG_SYNC_MS", "1000")) / 1000
+# Rooms whose log files stay open between flushes; the least recently written are closed
+LOG_MAX_OPEN_ROOMS = int(os.environ.get("CHAT_LOG_MAX_OPEN_ROOMS", "64"))
+# Worker processes rooms are spread over; 1 serves everything in this process
+SHARDS = int(os.environ.get("CHAT_SHARDS", "1"))
+# Shard i listens on 127.0.0.1 at SHARD_BASE_PORT + i
+SHARD_BASE_PORT = int(os.environ.get("CHAT_SHARD_BASE_PORT", str(PORT + 1)))
+# Router processes sharing the public port in sharded mode (needs SO_REUSEPORT)
+ROUTERS = int(os.environ.get("CHAT_ROUTERS", str(SHARDS)))
+
+logger = logging.getLogger("chat_server")
+
+# Ring slot: payload length followed by "ts|username|message" in UTF-8
+_LOG_SLOT_HEADER = struct.Struct(">I")
+# Sidecar index: total number of records written to the ring, then the ring
+# geometry (slot count, slot size) it was written with
+_LOG_INDEX = struct.Struct(">QII")
+
+
+if orjson is not None:
+    _dumps = orjson.dumps
+    # Accepts bytes frames directly; raises a json.JSONDecodeError subclass
+    _loads = orjson.loads
+else:
+    def _dumps(obj) -> bytes:
+        # Match orjson: compact output, returned as bytes ready for the wire
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    _loads = json.loads
+
+# Serialized form of a chat record; every field is spliced in as a JSON value
+_MESSAGE_TEMPLATE = b'{"type":"message","room":%b,"username":%b,"message":%b,"ts":"%b"}'
+# History reply wrapping already-serialized message payloads
+_HISTORY_TEMPLATE = b'{"type":"history","room":%b,"messages":[%b]}'
+
+
+@lru_cache(maxsize=4096)
+def _json_str(value: str) -> bytes:
+    # Room names and usernames repeat on every message, so escape each once
+    return _dumps(value)
+
+
+if broadcast_payload is None:
+    def broadcast_payload(puts: List[Callable[[bytes], None]], payload: bytes) -> List[int]:
+        # Returns the indices of the subscriber queues that were full
+        full = []
+        for i, put in enumerate(puts):
+            try:
+                put(payload)
+            except asyncio.QueueFull:
+                full.append(i)
+        return full
+
+
+def _join_frames(payloads: List[bytes]) -> bytes:
+    if len(payloads) == 1:
+        return payloads[0]
+    return b"[" + b",".join(payloads) + b"]"
+
+# fdatasync skips metadata updates where available (not on macOS/Windows)
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+def _encode_log_slot(ts: bytes, username: str, message: str) -> bytes:
+    line = b"%b|%b|%b" % (ts, username.encode("utf-8"), message.encode("utf-8"))
+    line = line[: LOG_RECORD_SIZE - _LOG_SLOT_HEADER.size]
+    return _LOG_SLOT_HEADER.pack(len(line)) + line.ljust(LOG_RECORD_SIZE - _LOG_SLOT_HEADER.size, b"\0")
+
+
+# Formats the current UTC time like datetime.isoformat(), as bytes ready to
+# splice into a payload; the date and seconds part is reused within a second
+class _UtcClock:
+    __slots__ = ("_sec", "_prefix")
+
+    def __init__(self) -> None:
+        self._sec = -1
+        self._prefix = b""
+
+    def now(self) -> bytes:
+        ns = time.time_ns()
+        sec = ns // 1_000_000_000
+        if sec != self._sec:
+            self._sec = sec
+            self._prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec)).encode("ascii")
+        return b"%b.%06d+00:00" % (self._prefix, (ns // 1000) % 1_000_000)
 
 
 class ChatServer:
@@ -24,40 +151,126 @@ class ChatServer:
         self.ws_to_username: Dict[websockets.WebSocketServerProtocol, str] = {}
         # Room to set of websockets (subscribers)
         self.room_to_subscribers: Dict[str, Set[websockets.WebSocketServerProtocol]] = defaultdict(set)
+        # Fan-out layout kept parallel to the set above: each subscriber's bound
+        # queue put_nowait and, at the same index, the websocket it feeds
+        self.room_to_puts: Dict[str, List[Callable[[bytes], None]]] = defaultdict(list)
+        self.room_to_members: Dict[str, List[websockets.WebSocketServerProtocol]] = defaultdict(list)
         # Websocket to subscribed rooms
         self.ws_to_rooms: Dict[websockets.WebSocketServerProtocol, Set[str]] = defaultdict(set)
-        # In-memory recent history per room (bounded)
-        self.room_to_history: Dict[str, Deque[dict]] = defaultdict(lambda: deque(maxlen=HISTORY_SIZE))
+        # In-memory recent history per room (bounded): a ring of serialized
+        # message payloads plus the number of payloads ever stored
+        self.room_to_history: Dict[str, List[Optional[bytes]]] = defaultdict(lambda: [None] * HISTORY_SIZE)
+        self.room_to_history_count: Dict[str, int] = defaultdict(int)
+        # Serializes seeding a cold room's history from disk
+        self.room_to_seed_lock: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # Room to number of records written to its on-disk ring (loaded lazily)
+        self.room_to_log_seq: Dict[str, int] = {}
+        # Encoded ring slots per room awaiting the background flusher
+        self.room_to_pending_log: Dict[str, List[bytes]] = defaultdict(list)
+        # Room to its open (ring, index) log files, least recently written first
+        self.room_to_log_files: "OrderedDict[str, Tuple[BinaryIO, BinaryIO]]" = OrderedDict()
+        # Duplicated descriptors of closed log files still owed an fdatasync
+        self._unsynced_fds: List[int] = []
+        self._flusher_task: Optional[asyncio.Task] = None
+        self._clock = _UtcClock()
+        # Websocket to bounded outbound queue, drained by one task per connection
+        self.ws_to_queue: Dict[websockets.WebSocketServerProtocol, asyncio.Queue] = {}
+        # Pending close tasks for dropped slow consumers (kept referenced until done)
+        self._close_tasks: Set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        self._flusher_task = asyncio.create_task(self._flusher())
+
+    async def stop(self) -> None:
+        if self._flusher_task is not None:
+            self._flusher_task.cancel()
+            self._flusher_task = None
+        self._flush_room_logs()
+        self._sync_fds(self._collect_sync_fds())
+        for files in self.room_to_log_files.values():
+            self._close_log_files(files)
+        self.room_to_log_files.clear()
 
     async def handler(self, websocket: websockets.WebSocketServerProtocol) -> None:
+        # Clients send binary frames, which websockets passes through as bytes
+        # without UTF-8 validation; the JSON parser checks the encoding itself
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.ws_to_queue[websocket] = queue
+        drainer = asyncio.create_task(self._drain_loop(websocket, queue))
+        # simdjson documents are lazy views into their parser's buffer, so each
+        # connection gets its own parser and only the needed keys are read
+        parse = simdjson.Parser().parse if simdjson is not None else _loads
         try:
             async for message in websocket:
                 try:
-                    data = json.loads(message)
-                except json.JSONDecodeError:
+                    data = parse(message)
+                    action = data.get("action")
+                except (ValueError, AttributeError):
+                    # AttributeError: valid JSON that is not an object
+                    data = None
                     await self._send_error(websocket, "invalid_json", "Message must be valid JSON")
                     continue
 
-                action = data.get("action")
-                if action == "login":
-                    await self._handle_login(websocket, data)
-                elif action == "subscribe":
-                    await self._handle_subscribe(websocket, data)
-                elif action == "publish":
-                    await self._handle_publish(websocket, data)
-                elif action == "logout":
-                    await self._handle_logout(websocket)
-                else:
-                    await self._send_error(websocket, "unknown_action", f"Unknown action: {action}")
+                try:
+                    # Only strings are actions; anything else may be a lazy
+                    # simdjson value and is not kept past this frame
+                    if not isinstance(action, str):
+                        action = None
+                    fn = self._DISPATCH.get(action)
+                    if fn is None:
+                        await self._send_error(websocket, "unknown_action", f"Unknown action: {action}")
+                    else:
+                        await fn(self, websocket, data)
+                finally:
+                    # The parser cannot be reused while a document is still referenced
+                    data = action = fn = None
         except websockets.ConnectionClosed:
-            # Ensure clean-up on disconnect
+            pass
+        finally:
+            # Ensure clean-up on disconnect, including normal closures
+            drainer.cancel()
             await self._cleanup(websocket)
+            # Dropped only here: the handler may still subscribe after a cleanup
+            self.ws_to_queue.pop(websocket, None)
+
+    async def _drain_loop(self, websocket: websockets.WebSocketServerProtocol, queue: asyncio.Queue) -> None:
+        try:
+            while True:
+                batch = [await queue.get()]
+                while len(batch) < SEND_BATCH and not queue.empty():
+                    batch.append(queue.get_nowait())
+                await self._send_batch(websocket, batch)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _send_batch(self, websocket: websockets.WebSocketServerProtocol, batch: List[bytes]) -> None:
+        # Consecutive JSON payloads go out as one array frame of at most about
+        # SEND_BATCH_BYTES; compressed payloads cannot be spliced and are sent
+        # on their own, in order
+        run: List[bytes] = []
+        run_size = 0
+        for payload in batch:
+            if payload[:1] == COMPRESSED_TAG:
+                if run:
+                    await websocket.send(_join_frames(run))
+                    run, run_size = [], 0
+                await websocket.send(payload)
+                continue
+            if run and run_size + len(payload) > SEND_BATCH_BYTES:
+                await websocket.send(_join_frames(run))
+                run, run_size = [], 0
+            run.append(payload)
+            run_size += len(payload) + 1
+        if run:
+            await websocket.send(_join_frames(run))
 
     async def _handle_login(self, websocket: websockets.WebSocketServerProtocol, data: dict) -> None:
         username = data.get("username")
         if not username or not isinstance(username, str):
             await self._send_error(websocket, "invalid_username", "'username' must be a non-empty string")
             return
+        # One canonical object per name keeps map lookups to an identity check
+        username = sys.intern(username)
 
         if username in self.username_to_ws:
             await self._send_error(websocket, "username_taken", "Username already in use")
@@ -75,14 +288,28 @@ class ChatServer:
         if not room or not isinstance(room, str):
             await self._send_error(websocket, "invalid_room", "'room' must be a non-empty string")
             return
-
-        # Register subscription
-        self.room_to_subscribers[room].add(websocket)
-        self.ws_to_rooms[websocket].add(room)
+        room = sys.intern(room)
         await self._send_ok(websocket, "subscribed", {"room": room})
+        await self._seed_history(room)
+
+        # Take the history snapshot and register with no await in between, so
+        # every message is either in the snapshot or broadcast to the queue
+        recent = self._recent_history(room, HISTORY_ON_SUBSCRIBE)
+        queue = self.ws_to_queue[websocket]
+        subs = self.room_to_subscribers[room]
+        if websocket not in subs:
+            subs.add(websocket)
+            self.room_to_puts[room].append(queue.put_nowait)
+            self.room_to_members[room].append(websocket)
+        self.ws_to_rooms[websocket].add(room)
 
-        # Send last N messages (history) to the subscriber
-        await self._send_recent_history(websocket, room, HISTORY_ON_SUBSCRIBE)
+        # Send last N messages (history) to the subscriber, through the queue so
+        # it goes out ahead of later broadcasts; stored payloads are spliced in as-is
+        if recent:
+            try:
+                queue.put_nowait(_HISTORY_TEMPLATE % (_json_str(room), b",".join(recent)))
+            except asyncio.QueueFull:
+                await self._drop_slow_consumer(websocket)
 
     async def _handle_publish(self, websocket: websockets.WebSocketServerProtocol, data: dict) -> None:
         room = data.get("room")
@@ -90,6 +317,7 @@ class ChatServer:
         if not room or not isinstance(room, str):
             await self._send_error(websocket, "invalid_room", "'room' must be a non-empty string")
             return
+        room = sys.intern(room)
         if not isinstance(message, str) or message == "":
             await self._send_error(websocket, "invalid_message", "'message' must be a non-empty string")
             return
@@ -99,102 +327,287 @@ class ChatServer:
             await self._send_error(websocket, "not_logged_in", "Login required before publishing")
             return
 
-        timestamp = datetime.now(timezone.utc).isoformat()
-        record = {"type": "message", "room": room, "username": username, "message": message, "ts": timestamp}
+        ts = self._clock.now()
+        # Only the message body needs escaping; room and username encodings are cached
+        payload = _MESSAGE_TEMPLATE % (_json_str(room), _json_str(username), _dumps(message), ts)
 
         # Append to in-memory history and persistent log
-        self.room_to_history[room].append(record)
-        self._append_to_room_log(room, record)
+        self._remember(room, payload)
+        self._append_to_room_log(room, ts, username, message)
 
         # Broadcast to all subscribers of the room
-        await self._broadcast(room, record)
+        await self._broadcast(room, payload)
 
-    async def _handle_logout(self, websocket: websockets.WebSocketServerProtocol) -> None:
+    async def _handle_logout(self, websocket: websockets.WebSocketServerProtocol, data: dict) -> None:
         await self._send_ok(websocket, "logout_ok", {})
         await self._cleanup(websocket)
         await websocket.close(code=1000, reason="logout")
 
-    async def _send_recent_history(self, websocket: websockets.WebSocketServerProtocol, room: str, count: int) -> None:
-        # Ensure in-memory cache is seeded from disk if empty
-        if len(self.room_to_history[room]) == 0:
-            for rec in self._read_last_lines_from_log(room, HISTORY_SIZE):
-                self.room_to_history[room].append(rec)
+    # Action name to handler; every handler takes (websocket, data)
+    _DISPATCH = {
+        "login": _handle_login,
+        "subscribe": _handle_subscribe,
+        "publish": _handle_publish,
+        "logout": _handle_logout,
+    }
+
+    async def _seed_history(self, room: str) -> None:
+        # Ensure in-memory cache is seeded from disk if empty; the read runs in
+        # a thread, and the lock keeps concurrent first subscribers to one read
+        if self.room_to_history_count[room] == 0:
+            async with self.room_to_seed_lock[room]:
+                if self.room_to_history_count[room] == 0:
+                    # Loaded here, on the loop, so any text log is migrated first
+                    end = self._room_log_seq(room)
+                    payloads = await asyncio.to_thread(self._read_last_lines_from_log, room, HISTORY_SIZE, end)
+                    # A publish during the read has already made the room warm
+                    if self.room_to_history_count[room] == 0:
+                        for payload in payloads:
+                            self._remember(room, payload)
+
+    def _remember(self, room: str, payload: bytes) -> None:
+        if HISTORY_SIZE <= 0:
+            # History disabled, as deque(maxlen=0) used to do
+            return
+        count = self.room_to_history_count[room]
+        self.room_to_history[room][count % HISTORY_SIZE] = payload
+        self.room_to_history_count[room] = count + 1
 
-        # Prepare last N from in-memory
-        recent = list(self.room_to_history[room])[-count:]
-        if recent:
-            await websocket.send(json.dumps({"type": "history", "room": room, "messages": recent}))
+    def _recent_history(self, room: str, count: int) -> List[bytes]:
+        if HISTORY_SIZE <= 0:
+            return []
+        end = self.room_to_history_count[room]
+        ring = self.room_to_history[room]
+        return [ring[i % HISTORY_SIZE] for i in range(max(0, end - min(count, HISTORY_SIZE)), end)]
 
-    async def _broadcast(self, room: str, record: dict) -> None:
-        subs = list(self.room_to_subscribers.get(room, set()))
-        if not subs:
+    async def _broadcast(self, room: str, payload: bytes) -> None:
+        puts = self.room_to_puts.get(room)
+        if not puts:
             return
-        payload = json.dumps(record)
-        # Send concurrently
-        await asyncio.gather(*[self._safe_send(ws, payload) for ws in subs])
-
-    async def _safe_send(self, websocket: websockets.WebSocketServerProtocol, payload: str) -> None:
-        try:
-            await websocket.send(payload)
-        except websockets.ConnectionClosed:
-            await self._cleanup(websocket)
+        if len(payload) >= COMPRESS_MIN_SIZE:
+            payload = COMPRESSED_TAG + zlib.compress(payload, 1)
+        # Hand off to each subscriber's drain task; a full queue means the
+        # client cannot keep up, so it is disconnected rather than buffered
+        full = broadcast_payload(puts, payload)
+        if full:
+            members = self.room_to_members[room]
+            for ws in [members[i] for i in full]:
+                await self._drop_slow_consumer(ws)
+
+    async def _drop_slow_consumer(self, websocket: websockets.WebSocketServerProtocol) -> None:
+        await self._cleanup(websocket)
+        # Close in the background so the publisher is not held up by the handshake
+        task = asyncio.create_task(websocket.close(code=4001, reason="slow_consumer"))
+        self._close_tasks.add(task)
+        task.add_done_callback(self._close_tasks.discard)
 
     async def _send_ok(self, websocket: websockets.WebSocketServerProtocol, event: str, data: dict) -> None:
-        await websocket.send(json.dumps({"type": "ok", "event": event, **data}))
+        await websocket.send(_dumps({"type": "ok", "event": event, **data}))
 
     async def _send_error(self, websocket: websockets.WebSocketServerProtocol, code: str, message: str) -> None:
-        await websocket.send(json.dumps({"type": "error", "code": code, "message": message}))
+        await websocket.send(_dumps({"type": "error", "code": code, "message": message}))
 
-    def _append_to_room_log(self, room: str, record: dict) -> None:
-        path = self._room_log_path(room)
-        line = f"{record['ts']}|{record['username']}|{record['message']}\n"
-        with open(path, "a", encoding="utf-8") as f:
-            f.write(line)
+    def _append_to_room_log(self, room: str, ts: bytes, username: str, message: str) -> None:
+        if HISTORY_SIZE <= 0:
+            # A zero-slot ring keeps nothing, so nothing is written
+            return
+        # Written out by the background flusher, off the publish path
+        self.room_to_pending_log[room].append(_encode_log_slot(ts, username, message))
+
+    async def _flusher(self) -> None:
+        loop = asyncio.get_running_loop()
+        last_sync = loop.time()
+        while True:
+            await asyncio.sleep(LOG_FLUSH_INTERVAL)
+            self._flush_room_logs()
+            if loop.time() - last_sync >= LOG_SYNC_INTERVAL:
+                # fdatasync blocks until the disk acknowledges, so keep it off the loop
+                await asyncio.to_thread(self._sync_fds, self._collect_sync_fds())
+                last_sync = loop.time()
+
+    def _flush_room_logs(self) -> None:
+        pending, self.room_to_pending_log = self.room_to_pending_log, defaultdict(list)
+        for room, slots in pending.items():
+            seq = self._room_log_seq(room)
+            # Only the newest HISTORY_SIZE records survive in the ring anyway
+            if len(slots) > HISTORY_SIZE:
+                seq += len(slots) - HISTORY_SIZE
+                slots = slots[-HISTORY_SIZE:]
+            try:
+                ring, idx = self._room_log_files(room)
+                # One write per contiguous run of slots, splitting where the ring wraps
+                remaining = slots
+                while remaining:
+                    slot = seq % HISTORY_SIZE
+                    run = remaining[: HISTORY_SIZE - slot]
+                    ring.seek(slot * LOG_RECORD_SIZE)
+                    ring.write(b"".join(run))
+                    seq += len(run)
+                    remaining = remaining[len(run) :]
+                ring.flush()
+                idx.seek(0)
+                idx.write(_LOG_INDEX.pack(seq, HISTORY_SIZE, LOG_RECORD_SIZE))
+                idx.flush()
+            except OSError as exc:
+                # Keep the slots for the next flush and reopen the files then;
+                # the write position only advances once a flush succeeds
+                logger.warning("Could not write log for room %r: %s", room, exc)
+                self.room_to_pending_log[room][:0] = slots
+                files = self.room_to_log_files.pop(room, None)
+                if files is not None:
+                    self._close_log_files(files)
+                continue
+            self.room_to_log_seq[room] = seq
+
+    def _collect_sync_fds(self) -> List[int]:
+        # Duplicates let the sync run in a thread while the loop closes files
+        fds, self._unsynced_fds = self._unsynced_fds, []
+        for files in self.room_to_log_files.values():
+            fds.extend(self._dup_fds(files))
+        return fds
+
+    @staticmethod
+    def _sync_fds(fds: List[int]) -> None:
+        for fd in fds:
+            try:
+                _fdatasync(fd)
+            except OSError as exc:
+                logger.warning("Could not sync log file: %s", exc)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _dup_fds(files: Tuple[BinaryIO, BinaryIO]) -> List[int]:
+        fds = []
+        for f in files:
+            try:
+                fds.append(os.dup(f.fileno()))
+            except OSError:
+                pass
+        return fds
+
+    @staticmethod
+    def _close_log_files(files: Tuple[BinaryIO, BinaryIO]) -> None:
+        for f in files:
+            try:
+                f.close()
+            except OSError as exc:
+                logger.warning("Could not close log file: %s", exc)
+
+    def _room_log_files(self, room: str) -> Tuple[BinaryIO, BinaryIO]:
+        files = self.room_to_log_files.get(room)
+        if files is not None:
+            self.room_to_log_files.move_to_end(room)
+            return files
+
+        # Bound open descriptors: close the least recently written rooms first
+        while self.room_to_log_files and len(self.room_to_log_files) >= LOG_MAX_OPEN_ROOMS:
+            _, old = self.room_to_log_files.popitem(last=False)
+            # Owed a sync, within the same descriptor budget as open rooms
+            if len(self._unsynced_fds) < 2 * LOG_MAX_OPEN_ROOMS:
+                self._unsynced_fds.extend(self._dup_fds(old))
+            self._close_log_files(old)
+
+        os.makedirs(LOG_DIR, exist_ok=True)
+        # Nothing usable on disk (new room, or another geometry): start a fresh ring
+        fresh = self._room_log_seq(room) == 0
+        opened: List[BinaryIO] = []
+        try:
+            for path in (self._room_log_path(room, "ring"), self._room_log_path(room, "idx")):
+                opened.append(open(path, "w+b" if fresh or not os.path.exists(path) else "r+b"))
+        except OSError:
+            for f in opened:
+                f.close()
+            raise
+        files = self.room_to_log_files[room] = (opened[0], opened[1])
+        return files
+
+    def _room_log_seq(self, room: str) -> int:
+        # First use of a room's ring, by the flusher or the seeder alike; this
+        # runs on the loop, so a migration never races with the flusher's writes
+        seq = self.room_to_log_seq.get(room)
+        if seq is None:
+            if HISTORY_SIZE > 0 and not os.path.exists(self._room_log_path(room, "idx")):
+                self._migrate_text_log(room)
+            seq = self.room_to_log_seq[room] = self._load_log_seq(room)
+        return seq
+
+    def _load_log_seq(self, room: str) -> int:
+        # Number of records ever written to the room's ring; 0 if none, or if
+        # the ring was laid out with a different HISTORY_SIZE/LOG_RECORD_SIZE
+        try:
+            with open(self._room_log_path(room, "idx"), "rb") as f:
+                seq, slots, slot_size = _LOG_INDEX.unpack(f.read(_LOG_INDEX.size))
+        except (OSError, struct.error):
+            return 0
+        if (slots, slot_size) != (HISTORY_SIZE, LOG_RECORD_SIZE):
+            return 0
+        return seq
+
+    def _migrate_text_log(self, room: str) -> bool:
+        # Builds the ring once from the tail of a pre-ring <room>.txt log
+        try:
+            with open(self._room_log_path(room, "txt"), "rb") as f:
+                lines = deque(f, maxlen=HISTORY_SIZE)
+        except OSError:
+            return False
+
+        slots = []
+        for line in lines:
+            try:
+                ts, username, msg = line.rstrip(b"\n").decode("utf-8", errors="ignore").split("|", 2)
+            except ValueError:
+                continue
+            slots.append(_encode_log_slot(ts.encode("utf-8"), username, msg))
+        try:
+            with open(self._room_log_path(room, "ring"), "wb") as f:
+                f.write(b"".join(slots))
+            with open(self._room_log_path(room, "idx"), "wb") as f:
+                f.write(_LOG_INDEX.pack(len(slots), HISTORY_SIZE, LOG_RECORD_SIZE))
+        except OSError as exc:
+            logger.warning("Could not migrate text log for room %r: %s", room, exc)
+            return False
+        return True
+
+    def _read_last_lines_from_log(self, room: str, count: int, end: int):
+        # end is the number of records written to the ring, from _room_log_seq
+        if HISTORY_SIZE <= 0 or end == 0:
+            return []
 
-    def _read_last_lines_from_log(self, room: str, count: int):
-        path = self._room_log_path(room)
-        if not os.path.exists(path):
+        # The ring is bounded, so read it whole and walk the slots oldest first
+        try:
+            with open(self._room_log_path(room, "ring"), "rb") as f:
+                ring = f.read()
+        except OSError:
             return []
 
-        # Efficiently read last N lines
-        lines: Deque[str] = deque(maxlen=count)
-        with open(path, "rb") as f:
-            # Read in chunks from end
-            f.seek(0, os.SEEK_END)
-            buffer = bytearray()
-            pointer = f.tell()
-            while pointer > 0 and len(lines) < count:
-                read_size = min(4096, pointer)
-                pointer -= read_size
-                f.seek(pointer)
-                chunk = f.read(read_size)
-                buffer[:0] = chunk
-                while b"\n" in buffer:
-                    idx = buffer.rfind(b"\n")
-                    line_bytes = buffer[idx + 1 :]
-                    buffer = buffer[:idx]
-                    if line_bytes:
-                        lines.appendleft(line_bytes.decode("utf-8", errors="ignore"))
-                if pointer == 0 and buffer:
-                    lines.appendleft(buffer.decode("utf-8", errors="ignore"))
-                    buffer.clear()
-
-        # Parse lines into records
         records = []
-        for line in lines:
-            line = line.rstrip("\n")
-            if not line:
+        for seq in range(max(0, end - min(count, HISTORY_SIZE)), end):
+            offset = (seq % HISTORY_SIZE) * LOG_RECORD_SIZE
+            if offset + _LOG_SLOT_HEADER.size > len(ring):
                 continue
+            (length,) = _LOG_SLOT_HEADER.unpack_from(ring, offset)
+            length = min(length, LOG_RECORD_SIZE - _LOG_SLOT_HEADER.size)
+            start = offset + _LOG_SLOT_HEADER.size
+            line = ring[start : start + length].decode("utf-8", errors="ignore")
             try:
                 ts, username, msg = line.split("|", 2)
-                records.append({"type": "message", "room": room, "username": username, "message": msg, "ts": ts})
             except ValueError:
                 continue
+            # ts is spliced inside quotes, so escape it in case the slot is corrupt
+            records.append(
+                _MESSAGE_TEMPLATE % (_json_str(room), _json_str(username), _dumps(msg), _dumps(ts)[1:-1])
+            )
         return records
 
-    def _room_log_path(self, room: str) -> str:
+    def _room_log_path(self, room: str, ext: str) -> str:
         safe_room = "".join(c for c in room if c.isalnum() or c in ("-", "_")) or "room"
-        return os.path.join(LOG_DIR, f"{safe_room}.txt")
+        if ext == "txt":
+            # Legacy text logs were named by the sanitized room alone
+            return os.path.join(LOG_DIR, f"{safe_room}.{ext}")
+        # Sanitizing can map rooms onto one name ("a.b", "ab"); a digest of the
+        # raw name keeps their rings apart
+        return os.path.join(LOG_DIR, f"{safe_room}-{zlib.crc32(room.encode('utf-8')):08x}.{ext}")
 
     async def _cleanup(self, websocket: websockets.WebSocketServerProtocol) -> None:
         # Remove from username maps
@@ -208,19 +621,253 @@ class ChatServer:
             subs = self.room_to_subscribers.get(room)
             if subs and websocket in subs:
                 subs.remove(websocket)
+                members = self.room_to_members[room]
+                i = members.index(websocket)
+                del members[i]
+                del self.room_to_puts[room][i]
                 if len(subs) == 0:
                     # Keep history map; subscribers set can remain empty
                     pass
 
 
-async def main() -> None:
+def _shard_for(key: str) -> int:
+    # crc32 rather than hash(): every process must agree on the owner
+    return zlib.crc32(key.encode("utf-8")) % SHARDS
+
+
+def _route_fields(parse: Callable, message) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    # The action, room and username of a frame, each None unless a string.
+    # Only these keys are read, and no lazily parsed value outlives the call.
+    try:
+        data = parse(message)
+        action, room, username = data.get("action"), data.get("room"), data.get("username")
+    except (ValueError, AttributeError):
+        return None, None, None
+    return (
+        action if isinstance(action, str) else None,
+        room if isinstance(room, str) else None,
+        username if isinstance(username, str) else None,
+    )
+
+
+class ShardRouter:
+    # Front end for sharded mode. Each client frame is relayed to the shard
+    # process owning its room, over one upstream connection per shard used by
+    # that client; shard replies are relayed back unchanged. A client must log
+    # in first: the login goes to the shard owning the username, which keeps
+    # names unique, and is then replayed on every other upstream it opens.
+    #
+    # Routers keep no shared state, so several run side by side on the public
+    # port (CHAT_ROUTERS, via SO_REUSEPORT). Every delivery still costs its
+    # router one receive and one send, but frames are relayed as raw bytes and
+    # only the routing keys of inbound frames are read.
+    #
+    # Ordering is only preserved per shard: replies and messages coming from
+    # different shards may reach the client in a different order than the
+    # frames that caused them (e.g. "subscribed r2" before "subscribed r1").
+    #
+    # When a shard closes an upstream, the client sees what it would have seen
+    # from a single server: closes with an application code (username_taken,
+    # slow_consumer) and any close of the home upstream are passed on to the
+    # client; another shard going away is reported as an error, and the next
+    # frame for it reconnects.
+
+    def __init__(self, shard_ports: List[int]) -> None:
+        self.shard_uris = [f"ws://127.0.0.1:{port}" for port in shard_ports]
+
+    async def handler(self, websocket: websockets.WebSocketServerProtocol) -> None:
+        upstreams: Dict[int, websockets.WebSocketClientProtocol] = {}
+        relays: List[asyncio.Task] = []
+        login: Optional[bytes] = None
+        home = 0
+        parse = simdjson.Parser().parse if simdjson is not None else _loads
+        try:
+            async for message in websocket:
+                action, room, username = _route_fields(parse, message)
+
+                if login is None:
+                    if action != "login":
+                        await self._send_error(websocket, "not_logged_in", "Login required first")
+                        continue
+                    home = _shard_for(username) if username is not None else 0
+                    upstream = await self._connect(websocket, home, message, relay_ok=True)
+                    if upstream is None:
+                        continue
+                    upstreams[home] = upstream
+                    relays.append(asyncio.create_task(self._relay(websocket, upstreams, home, close_client=True)))
+                    login = message
+                    continue
+
+                if home not in upstreams:
+                    # The home shard closed; its relay is closing the client
+                    break
+
+                if action == "logout":
+                    # Only the home shard answers, then closes both connections
+                    for shard, upstream in list(upstreams.items()):
+                        if shard != home:
+                            await upstreams.pop(shard).close()
+                    await self._send_upstream(upstreams[home], message)
+                    continue
+
+                shard = _shard_for(room) if room else home
+                upstream = upstreams.get(shard)
+                if upstream is None:
+                    upstream = await self._connect(websocket, shard, login, relay_ok=False)
+                    if upstream is None:
+                        continue
+                    upstreams[shard] = upstream
+                    relays.append(asyncio.create_task(self._relay(websocket, upstreams, shard, close_client=False)))
+                await self._send_upstream(upstream, message)
+        except websockets.ConnectionClosed:
+            # Only the client's own connection; upstream closures end in _relay
+            pass
+        finally:
+            for task in relays:
+                task.cancel()
+            for upstream in upstreams.values():
+                await upstream.close()
+
+    async def _connect(
+        self, websocket: websockets.WebSocketServerProtocol, shard: int, login: bytes, relay_ok: bool
+    ) -> Optional[websockets.WebSocketClientProtocol]:
+        # Opens an upstream to the shard and logs it in. A failed login is
+        # relayed to the client and None returned; login_ok is relayed only
+        # when asked, so the client sees it once, from the home shard.
+        try:
+            upstream = await websockets.connect(self.shard_uris[shard], compression=None)
+            await upstream.send(login)
+            reply = await upstream.recv()
+        except (OSError, websockets.ConnectionClosed):
+            await self._send_error(websocket, "shard_unavailable", "Room server is not reachable")
+            return None
+        data = _loads(reply)
+        if data.get("type") == "ok":
+            if relay_ok:
+                await websocket.send(reply)
+            return upstream
+        await upstream.close()
+        await websocket.send(reply)
+        if data.get("code") == "username_taken":
+            await websocket.close(code=4000, reason="username_taken")
+        return None
+
+    @staticmethod
+    async def _send_upstream(upstream: websockets.WebSocketClientProtocol, message) -> None:
+        try:
+            await upstream.send(message)
+        except websockets.ConnectionClosed:
+            # The shard closed it; the upstream's relay tells the client
+            pass
+
+    async def _relay(
+        self,
+        websocket: websockets.WebSocketServerProtocol,
+        upstreams: Dict[int, websockets.WebSocketClientProtocol],
+        shard: int,
+        close_client: bool,
+    ) -> None:
+        upstream = upstreams[shard]
+        try:
+            async for message in upstream:
+                try:
+                    await websocket.send(message)
+                except websockets.ConnectionClosed:
+                    # The client went away; the handler closes the upstreams
+                    return
+        except websockets.ConnectionClosed:
+            pass
+
+        if upstreams.get(shard) is not upstream:
+            # Closed by the handler itself (logout)
+            return
+        # Forget the closed upstream so the next frame for the shard reconnects
+        del upstreams[shard]
+        code, reason = upstream.close_code, upstream.close_reason
+        try:
+            if close_client or 3000 <= code < 5000:
+                if code not in (1000, 1001) and not 3000 <= code < 5000:
+                    # Abnormal closures (e.g. 1006, the shard died) cannot be sent on
+                    code, reason = 1011, "shard_unavailable"
+                await websocket.close(code=code, reason=reason)
+            else:
+                await self._send_error(websocket, "shard_unavailable", "Room server connection was lost")
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _send_error(self, websocket: websockets.WebSocketServerProtocol, code: str, message: str) -> None:
+        await websocket.send(_dumps({"type": "error", "code": code, "message": message}))
+
+
+async def run_server(host: str, port: int) -> None:
     server = ChatServer()
-    async with websockets.serve(server.handler, HOST, PORT):
-        print(f"Chat server running on {HOST}:{PORT}. Logs in {LOG_DIR}")
+    await server.start()
+    try:
+        # Per-connection permessage-deflate is disabled; broadcasts are compressed once instead
+        async with websockets.serve(server.handler, host, port, compression=None):
+            print(f"Chat server running on {host}:{port}. Logs in {LOG_DIR}")
+            await asyncio.Future()  # Run forever
+    finally:
+        await server.stop()
+
+
+async def run_router(host: str, port: int, shard_ports: List[int], reuse_port: bool) -> None:
+    router = ShardRouter(shard_ports)
+    async with websockets.serve(router.handler, host, port, compression=None, reuse_port=reuse_port):
+        print(f"Chat router {os.getpid()} running on {host}:{port} across {len(shard_ports)} shards")
         await asyncio.Future()  # Run forever
 
 
+def _run_shard(port: int) -> None:
+    # Terminate like Ctrl+C so pending room logs are flushed on the way out
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    _install_uvloop()
+    try:
+        asyncio.run(run_server("127.0.0.1", port))
+    except KeyboardInterrupt:
+        pass
+
+
+def _run_router(shard_ports: List[int]) -> None:
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    _install_uvloop()
+    try:
+        asyncio.run(run_router(HOST, PORT, shard_ports, reuse_port=True))
+    except KeyboardInterrupt:
+        pass
+
+
+def _install_uvloop() -> None:
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+async def main() -> None:
+    if SHARDS <= 1:
+        await run_server(HOST, PORT)
+        return
+
+    ports = [SHARD_BASE_PORT + i for i in range(SHARDS)]
+    routers = max(1, ROUTERS)
+    if routers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        logger.warning("SO_REUSEPORT is unavailable; running a single router")
+        routers = 1
+    # This process is one of the routers; the rest are started alongside the shards
+    workers = [multiprocessing.Process(target=_run_shard, args=(port,), daemon=True) for port in ports]
+    workers += [multiprocessing.Process(target=_run_router, args=(ports,), daemon=True) for _ in range(routers - 1)]
+    for worker in workers:
+        worker.start()
+    try:
+        await run_router(HOST, PORT, ports, reuse_port=routers > 1)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
 if __name__ == "__main__":
+    _install_uvloop()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
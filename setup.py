@@ -0,0 +1,9 @@
+# Builds the optional fan-out extension used by chat_server:
+#   python setup.py build_ext --inplace
+from Cython.Build import cythonize
+from setuptools import setup
+
+setup(
+    name="chat-room-fanout",
+    ext_modules=cythonize("_fanout.pyx"),
+)